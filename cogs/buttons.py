@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 import asyncio
-from typing import TYPE_CHECKING, Any, Callable, MutableMapping, NamedTuple, Optional, Set, TypedDict
+from typing import TYPE_CHECKING, Any, MutableMapping, NamedTuple, Optional, Set, TypedDict
 from typing_extensions import Self, Annotated
 from discord.ext import commands
 from discord import app_commands
@@ -9,10 +9,13 @@ import discord
 import random
 import logging
 from lru import LRU
+import aiohttp
 import yarl
 import io
 import re
 
+from .utils import cache
+
 log = logging.getLogger(__name__)
 
 if TYPE_CHECKING:
@@ -40,30 +43,36 @@ SPOILER_EMOJI_ID = 430469957042831371
 
 
 class ConvertibleUnit(NamedTuple):
-    # (value) -> (converted, unit)
-    formula: Callable[[float], tuple[float, str]]
-    capture: str
+    # lowercase spellings that refer to this unit
+    aliases: tuple[str, ...]
 
 
+# The conversion formulas themselves live in Unit.converted
 UNIT_CONVERSIONS: dict[str, ConvertibleUnit] = {
-    'km': ConvertibleUnit(lambda v: (v * 0.621371, 'mi'), r'km|(?:kilometer|kilometre)s?'),
-    'm': ConvertibleUnit(lambda v: (v * 3.28084, 'ft'), r'm|(?:meter|metre)s?'),
-    'ft': ConvertibleUnit(lambda v: (v * 0.3048, 'm'), r'ft|feet|foot'),
-    'cm': ConvertibleUnit(lambda v: (v * 0.393701, 'in'), r'cm|(?:centimeter|centimetre)s?'),
-    'in': ConvertibleUnit(lambda v: (v * 2.54, 'cm'), r'in|inch(?:es)?'),
-    'mi': ConvertibleUnit(lambda v: (v * 1.60934, 'km'), r'mi|miles?'),
-    'kg': ConvertibleUnit(lambda v: (v * 2.20462, 'lb'), r'kg|kilograms?'),
-    'lb': ConvertibleUnit(lambda v: (v * 0.453592, 'kg'), r'(?:lb|pound)s?'),
-    'L': ConvertibleUnit(lambda v: (v * 0.264172, 'gal'), r'l|(?:liter|litre)s?'),
-    'gal': ConvertibleUnit(lambda v: (v * 3.78541, 'L'), r'gal|gallons?'),
-    'C': ConvertibleUnit(lambda v: (v * 1.8 + 32, 'F'), r'c|°c|celsius'),
-    'F': ConvertibleUnit(lambda v: ((v - 32) / 1.8, 'C'), r'f|°f|fahrenheit'),
+    'km': ConvertibleUnit(('km', 'kilometer', 'kilometers', 'kilometre', 'kilometres')),
+    'm': ConvertibleUnit(('m', 'meter', 'meters', 'metre', 'metres')),
+    'ft': ConvertibleUnit(('ft', 'feet', 'foot')),
+    'cm': ConvertibleUnit(('cm', 'centimeter', 'centimeters', 'centimetre', 'centimetres')),
+    'in': ConvertibleUnit(('in', 'inch', 'inches')),
+    'mi': ConvertibleUnit(('mi', 'mile', 'miles')),
+    'kg': ConvertibleUnit(('kg', 'kilogram', 'kilograms')),
+    'lb': ConvertibleUnit(('lb', 'lbs', 'pound', 'pounds')),
+    'L': ConvertibleUnit(('l', 'liter', 'liters', 'litre', 'litres')),
+    'gal': ConvertibleUnit(('gal', 'gallon', 'gallons')),
+    'C': ConvertibleUnit(('c', '°c', 'celsius')),
+    'F': ConvertibleUnit(('f', '°f', 'fahrenheit')),
 }
 
-UNIT_CONVERSION_REGEX_COMPONENT = '|'.join(f'(?P<{name}>{unit.capture})' for name, unit in UNIT_CONVERSIONS.items())
-UNIT_CONVERSION_REGEX = re.compile(
-    rf'(?P<value>\-?[0-9]+(?:[,.][0-9]+)?)\s*(?:{UNIT_CONVERSION_REGEX_COMPONENT})\b', re.IGNORECASE
-)
+# lowercase alias -> canonical unit key, e.g. 'kilometres' -> 'km'
+_UNIT_TOKEN_TO_KEY: dict[str, str] = {alias: name for name, unit in UNIT_CONVERSIONS.items() for alias in unit.aliases}
+
+# Longest first so that e.g. 'miles' is tried before 'mi' and 'm'
+# This is case sensitive, input is lowercased before matching instead
+UNIT_CONVERSION_REGEX_COMPONENT = '|'.join(map(re.escape, sorted(_UNIT_TOKEN_TO_KEY, key=len, reverse=True)))
+UNIT_CONVERSION_REGEX = re.compile(rf'(\-?[0-9]+(?:[,.][0-9]+)?)\s*({UNIT_CONVERSION_REGEX_COMPONENT})\b')
+_UCR_MATCH = UNIT_CONVERSION_REGEX.match
+_UCR_FINDITER = UNIT_CONVERSION_REGEX.finditer
+_DIGITS = frozenset('0123456789')
 
 
 class Unit(NamedTuple):
@@ -72,19 +81,43 @@ class Unit(NamedTuple):
 
     @classmethod
     async def convert(cls, ctx: Context, argument: str) -> Self:
-        match = UNIT_CONVERSION_REGEX.match(argument)
+        match = _UCR_MATCH(argument.lower())
         if match is None:
             raise commands.BadArgument('Could not find a unit')
 
-        value = float(match.group('value'))
-        unit = match.lastgroup
-        if unit is None:
-            raise commands.BadArgument('Could not find a unit')
-
+        value = float(match.group(1))
+        unit = _UNIT_TOKEN_TO_KEY[match.group(2)]
         return cls(value, unit)
 
     def converted(self) -> Unit:
-        return Unit(*UNIT_CONVERSIONS[self.unit].formula(self.value))
+        u = self.unit
+        v = self.value
+        if u == 'km':
+            return Unit(v * 0.621371, 'mi')
+        elif u == 'm':
+            return Unit(v * 3.28084, 'ft')
+        elif u == 'ft':
+            return Unit(v * 0.3048, 'm')
+        elif u == 'cm':
+            return Unit(v * 0.393701, 'in')
+        elif u == 'in':
+            return Unit(v * 2.54, 'cm')
+        elif u == 'mi':
+            return Unit(v * 1.60934, 'km')
+        elif u == 'kg':
+            return Unit(v * 2.20462, 'lb')
+        elif u == 'lb':
+            return Unit(v * 0.453592, 'kg')
+        elif u == 'L':
+            return Unit(v * 0.264172, 'gal')
+        elif u == 'gal':
+            return Unit(v * 3.78541, 'L')
+        elif u == 'C':
+            return Unit(v * 1.8 + 32, 'F')
+        elif u == 'F':
+            return Unit((v - 32) / 1.8, 'C')
+
+        raise ValueError(f'Unknown unit {u!r}')
 
     @property
     def display_unit(self) -> str:
@@ -96,19 +129,36 @@ class Unit(NamedTuple):
 
 class UnitCollector(commands.Converter):
     async def convert(self, ctx: Context, argument: str) -> set[Unit]:
-        units = set()
-        for match in UNIT_CONVERSION_REGEX.finditer(argument):
-            value = float(match.group('value'))
-            unit = match.lastgroup
-            if unit is None:
-                raise commands.BadArgument('Could not find a unit')
+        # Every unit needs a number in front of it, so text without any digits
+        # can be rejected without lowercasing it or running the regex over it
+        if _DIGITS.isdisjoint(argument):
+            raise commands.BadArgument('Could not find a unit')
 
-            units.add(Unit(value, unit))
+        raw: list[tuple[float, str]] = []
+        raw_append = raw.append
+        for match in _UCR_FINDITER(argument.lower()):
+            raw_append((float(match.group(1)), _UNIT_TOKEN_TO_KEY[match.group(2)]))
 
-        if not units:
+        if not raw:
             raise commands.BadArgument('Could not find a unit')
 
-        return units
+        # Deduplicate the plain tuples first so no throwaway Unit is built
+        return {Unit(value, unit) for value, unit in set(raw)}
+
+
+REDDIT_HEADERS = {
+    'User-Agent': 'Discord:RoboDanny:v4.0 (by /u/Rapptz)',
+}
+
+
+# maxsize is the TTL in seconds for the timed strategy
+@cache.cache(strategy=cache.Strategy.timed, maxsize=300, ignore_kwargs=True)
+async def resolve_vreddit_url(url: str, *, session: aiohttp.ClientSession) -> yarl.URL:
+    # the key is str() of an already parsed URL so it's safe to skip re-encoding it
+    async with session.get(yarl.URL(url, encoded=True), headers=REDDIT_HEADERS) as resp:
+        # raising here ensures rate limits or server errors are never cached as a resolved URL
+        resp.raise_for_status()
+        return resp.url
 
 
 class RedditMediaURL:
@@ -123,21 +173,28 @@ class RedditMediaURL:
         except Exception as e:
             raise commands.BadArgument('Not a valid URL.')
 
-        headers = {
-            'User-Agent': 'Discord:RoboDanny:v4.0 (by /u/Rapptz)',
-        }
         await ctx.typing()
         if url.host == 'v.redd.it':
             # have to do a request to fetch the 'main' URL.
-            async with ctx.session.get(url, headers=headers) as resp:
-                url = resp.url
+            # this is cached since the same post tends to get requested a few times in a row
+            key = str(url)
+            try:
+                # shielded so a cancelled caller doesn't leave a cancelled task in the cache
+                url = await asyncio.shield(resolve_vreddit_url(key, session=ctx.session))
+            except aiohttp.ClientResponseError as e:
+                resolve_vreddit_url.invalidate(key)
+                raise commands.BadArgument(f'Reddit failed with {e.status}.') from e
+            except Exception:
+                # don't keep failures around
+                resolve_vreddit_url.invalidate(key)
+                raise
 
         is_valid_path = url.host and url.host.endswith('.reddit.com')
         if not is_valid_path:
             raise commands.BadArgument('Not a reddit URL.')
 
         # Now we go the long way
-        async with ctx.session.get(url / '.json', headers=headers) as resp:
+        async with ctx.session.get(url / '.json', headers=REDDIT_HEADERS) as resp:
             if resp.status != 200:
                 raise commands.BadArgument(f'Reddit API failed with {resp.status}.')
 
@@ -165,6 +222,23 @@ class RedditMediaURL:
             return cls(fallback_url)
 
 
+SUPPORTED_ATTACHMENTS = ('png', 'jpg', 'jpeg', 'webm', 'gif', 'mp4', 'txt')
+_SUPPORTED_ATTACHMENTS_SET = frozenset(SUPPORTED_ATTACHMENTS)
+
+
+def is_supported_attachment(filename: str) -> bool:
+    index = filename.rfind('.')
+    if index == -1:
+        return False
+
+    ext = filename[index + 1 :]
+    # most extensions are already lowercase so skip the .lower() copy when possible
+    return ext in _SUPPORTED_ATTACHMENTS_SET or ext.lower() in _SUPPORTED_ATTACHMENTS_SET
+
+
+HIDDEN_SPOILER_DESCRIPTION = 'This spoiler has been hidden. Press the button to reveal it!'
+
+
 class SpoilerCacheData(TypedDict):
     author_id: int
     channel_id: int
@@ -174,7 +248,7 @@ class SpoilerCacheData(TypedDict):
 
 
 class SpoilerCache:
-    __slots__ = ('author_id', 'channel_id', 'title', 'text', 'attachments')
+    __slots__ = ('author_id', 'channel_id', 'title', 'text', 'attachments', '_has_single_image')
 
     def __init__(self, data: SpoilerCacheData):
         self.author_id: int = data['author_id']
@@ -182,9 +256,12 @@ class SpoilerCache:
         self.title: str = data['title']
         self.text: Optional[str] = data['text']
         self.attachments: list[discord.Attachment] = data['attachments']
+        self._has_single_image: bool = bool(self.attachments) and self.attachments[0].filename.lower().endswith(
+            ('.gif', '.png', '.jpg', '.jpeg')
+        )
 
     def has_single_image(self) -> bool:
-        return bool(self.attachments) and self.attachments[0].filename.lower().endswith(('.gif', '.png', '.jpg', '.jpeg'))
+        return self._has_single_image
 
     def to_embed(self, bot: RoboDanny) -> discord.Embed:
         embed = discord.Embed(title=f'{self.title} Spoiler', colour=0x01AEEE)
@@ -200,7 +277,17 @@ class SpoilerCache:
             attachments = self.attachments
 
         if attachments:
-            value = '\n'.join(f'[{a.filename}]({a.url})' for a in attachments)
+            parts = []
+            append = parts.append
+            for a in attachments:
+                append('[')
+                append(a.filename)
+                append('](')
+                append(a.url)
+                append(')\n')
+
+            parts[-1] = ')'  # no trailing newline
+            value = ''.join(parts)
             embed.add_field(name='Attachments', value=value, inline=False)
 
         user = bot.get_user(self.author_id)
@@ -210,13 +297,13 @@ class SpoilerCache:
         return embed
 
     def to_spoiler_embed(self, ctx: Context, storage_message: discord.abc.Snowflake) -> discord.Embed:
-        description = 'This spoiler has been hidden. Press the button to reveal it!'
-        embed = discord.Embed(title=f'{self.title} Spoiler', description=description)
         if self.has_single_image() and self.text is None:
-            embed.title = f'{self.title} Spoiler Image'
+            title = f'{self.title} Spoiler Image'
+        else:
+            title = f'{self.title} Spoiler'
 
+        embed = discord.Embed(title=title, description=HIDDEN_SPOILER_DESCRIPTION, colour=0x01AEEE)
         embed.set_footer(text=storage_message.id)
-        embed.colour = 0x01AEEE
         embed.set_author(name=ctx.author, icon_url=ctx.author.display_avatar.url)
         return embed
 
@@ -225,12 +312,13 @@ class SpoilerCooldown(commands.CooldownMapping):
     def __init__(self):
         super().__init__(commands.Cooldown(1, 10.0), commands.BucketType.user)
 
-    def _bucket_key(self, tup: tuple[int, int]) -> tuple[int, int]:
-        return tup
+    def _bucket_key(self, key: int) -> int:
+        return key
 
     def is_rate_limited(self, message_id: int, user_id: int) -> bool:
-        # This is a lie but it should just work as-is
-        bucket = self.get_bucket((message_id, user_id))  # type: ignore
+        # Snowflakes fit in 64 bits so both IDs can be packed into a single int key
+        # Passing an int is a lie but it should just work as-is
+        bucket = self.get_bucket((message_id << 64) | user_id)  # type: ignore
         return bucket is not None and bucket.update_rate_limit() is not None
 
 
@@ -284,7 +372,11 @@ class Buttons(commands.Cog):
     def __init__(self, bot: RoboDanny):
         self.bot: RoboDanny = bot
         self._spoiler_cache: MutableMapping[int, SpoilerCache] = LRU(128)
+        # message_id -> lookup currently running for it, so concurrent reveals share one fetch
+        self._spoiler_lookups: dict[int, asyncio.Task[Optional[SpoilerCache]]] = {}
         self._spoiler_cooldown = SpoilerCooldown()
+        self._feedback_channel: Optional[discord.TextChannel] = None
+        self._storage_channel: Optional[discord.TextChannel] = None
         self._spoiler_view = SpoilerView(self)
         bot.add_view(self._spoiler_view)
 
@@ -297,19 +389,34 @@ class Buttons(commands.Cog):
 
     @property
     def feedback_channel(self) -> Optional[discord.TextChannel]:
+        if self._feedback_channel is not None:
+            return self._feedback_channel
+
         guild = self.bot.get_guild(182325885867786241)
         if guild is None:
             return None
 
-        return guild.get_channel(263814407191134218)  # type: ignore
+        self._feedback_channel = guild.get_channel(263814407191134218)  # type: ignore
+        return self._feedback_channel
 
     @property
     def storage_channel(self) -> Optional[discord.TextChannel]:
+        if self._storage_channel is not None:
+            return self._storage_channel
+
         guild = self.bot.get_guild(182325885867786241)
         if guild is None:
             return None
 
-        return guild.get_channel(430229522340773899)  # type: ignore
+        self._storage_channel = guild.get_channel(430229522340773899)  # type: ignore
+        return self._storage_channel
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel):
+        if self._feedback_channel is not None and channel.id == self._feedback_channel.id:
+            self._feedback_channel = None
+        if self._storage_channel is not None and channel.id == self._storage_channel.id:
+            self._storage_channel = None
 
     @commands.command(hidden=True)
     async def feelgood(self, ctx: Context):
@@ -420,31 +527,70 @@ class Buttons(commands.Cog):
         if storage is None:
             raise RuntimeError('Spoiler storage was not found')
 
-        supported_attachments = ('.png', '.jpg', '.jpeg', '.webm', '.gif', '.mp4', '.txt')
-        if not all(attach.filename.lower().endswith(supported_attachments) for attach in ctx.message.attachments):
-            raise RuntimeError(f'Unsupported file in attachments. Only {", ".join(supported_attachments)} supported.')
+        if not all(is_supported_attachment(attach.filename) for attach in ctx.message.attachments):
+            supported = ', '.join(f'.{ext}' for ext in SUPPORTED_ATTACHMENTS)
+            raise RuntimeError(f'Unsupported file in attachments. Only {supported} supported.')
 
-        files = []
-        total_bytes = 0
-        max_mib = 25 * 1024 * 1024
-        for attach in ctx.message.attachments:
-            async with ctx.session.get(attach.url) as resp:
+        semaphore = asyncio.Semaphore(4)
+        session_get = ctx.session.get
+
+        async def fetch(attach: discord.Attachment) -> Optional[discord.File]:
+            # attachment URLs are already encoded, this saves aiohttp from parsing them again
+            async with semaphore, session_get(yarl.URL(attach.url, encoded=True)) as resp:
                 if resp.status != 200:
-                    continue
+                    return None
+
+                fp = io.BytesIO()
+                async for chunk in resp.content.iter_chunked(65536):
+                    fp.write(chunk)
+
+                fp.seek(0)
+                return discord.File(fp, filename=attach.filename)
 
-                content_length = int(resp.headers['Content-Length'])
+        attachments = ctx.message.attachments
+        max_mib = 25 * 1024 * 1024
+        failed: set[int] = set()
+        downloaded: dict[int, discord.File] = {}
+
+        # Discord already tells us the attachment sizes so the budget
+        # can be applied before anything is downloaded
+        def within_budget() -> list[int]:
+            kept = []
+            total_bytes = 0
+            for index, attach in enumerate(attachments):
+                # failed downloads don't take up any of the budget
+                if index in failed:
+                    continue
 
                 # file too big, skip it
-                if (total_bytes + content_length) > max_mib:
+                if (total_bytes + attach.size) > max_mib:
                     continue
 
-                total_bytes += content_length
-                fp = io.BytesIO(await resp.read())
-                files.append(discord.File(fp, filename=attach.filename))
+                total_bytes += attach.size
+                kept.append(index)
+
+                if total_bytes >= max_mib:
+                    break
 
-            if total_bytes >= max_mib:
+            return kept
+
+        # If a download fails the budget is applied again without it,
+        # so the files kept are the same as downloading them one by one in order
+        while True:
+            kept = within_budget()
+            missing = [index for index in kept if index not in downloaded]
+            if not missing:
                 break
 
+            results = await asyncio.gather(*(fetch(attachments[index]) for index in missing))
+            for index, file in zip(missing, results):
+                if file is None:
+                    failed.add(index)
+                else:
+                    downloaded[index] = file
+
+        files = [downloaded[index] for index in kept]
+
         # on mobile, messages that are deleted immediately sometimes persist client side
         await asyncio.sleep(0.2)
         await ctx.message.delete()
@@ -472,11 +618,20 @@ class Buttons(commands.Cog):
         return message, cache
 
     async def get_spoiler_cache(self, channel_id: int, message_id: int) -> Optional[SpoilerCache]:
-        try:
-            return self._spoiler_cache[message_id]
-        except KeyError:
-            pass
+        cached = self._spoiler_cache.get(message_id)
+        if cached is not None:
+            return cached
+
+        task = self._spoiler_lookups.get(message_id)
+        if task is None:
+            task = asyncio.create_task(self._fetch_spoiler_cache(channel_id, message_id))
+            task.add_done_callback(lambda _: self._spoiler_lookups.pop(message_id, None))
+            self._spoiler_lookups[message_id] = task
 
+        # shielded so one cancelled waiter doesn't cancel the lookup for everyone else
+        return await asyncio.shield(task)
+
+    async def _fetch_spoiler_cache(self, channel_id: int, message_id: int) -> Optional[SpoilerCache]:
         storage = self.storage_channel
         if storage is None:
             return None
@@ -569,11 +724,18 @@ class Buttons(commands.Cog):
             if resp.status != 200:
                 return await ctx.send('Could not download video.')
 
-            if int(resp.headers['Content-Length']) >= filesize:
+            if (resp.content_length or 0) >= filesize:
                 return await ctx.send('Video is too big to be uploaded.')
 
-            data = await resp.read()
-            await ctx.send(file=discord.File(io.BytesIO(data), filename=reddit.filename))
+            # Content-Length can't be trusted outright, so enforce the limit while downloading as well
+            fp = io.BytesIO()
+            async for chunk in resp.content.iter_chunked(65536):
+                fp.write(chunk)
+                if fp.tell() >= filesize:
+                    return await ctx.send('Video is too big to be uploaded.')
+
+            fp.seek(0)
+            await ctx.send(file=discord.File(fp, filename=reddit.filename))
 
     @vreddit.error
     async def on_vreddit_error(self, ctx: Context, error: commands.CommandError):
@@ -602,13 +764,15 @@ class Buttons(commands.Cog):
             values = await UnitCollector().convert(ctx, reply.content)
 
         pairs: list[tuple[str, str]] = []
+        width = 0
         for value in values:
             original = f'{value.value:g}{value.display_unit}'
             converted = value.converted()
             pairs.append((original, f'{converted.value:g}{converted.display_unit}'))
+            # Pad for width since this is monospace
+            if len(original) > width:
+                width = len(original)
 
-        # Pad for width since this is monospace
-        width = max(len(original) for original, _ in pairs)
         fmt = '\n'.join(f'{original:<{width}} -> {converted}' for original, converted in pairs)
         await ctx.send(f'```\n{fmt}\n```')
 